@@ -0,0 +1,191 @@
+import atexit
+import concurrent.futures
+import concurrent.futures.process
+import dataclasses
+import logging
+import multiprocessing
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+from utils import StrEnum
+
+logger = logging.getLogger(__name__)
+
+# each spawned worker re-imports the job's modules (about 80 MB with streamlit and PIL)
+# and keeps its own image cache (printing_utils._fetch_image, up to about 30 MB)
+MAX_WORKERS = 2
+MAX_PENDING = 8
+RESULT_TTL = 60 * 10
+# finished results are whole PDFs (a few MB each), keep at most this many
+MAX_RESULTS = 16
+
+
+class JobState(StrEnum):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+
+FINISHED = (JobState.DONE, JobState.FAILED, JobState.CANCELLED)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class SchedulerBusy(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class Job:
+    job_id: str
+    submitted_at: float
+    state: JobState = JobState.PENDING
+    progress: Dict[str, int] = dataclasses.field(default_factory=dict)
+    result: Any = None
+    error: Optional[str] = None
+    finished_at: Optional[float] = None
+
+
+def _run(fn: Callable, job_id: str, shared, args, kwargs):
+    """Runs in a worker process; `fn` reports progress with `progress(**counts)`"""
+    counts_so_far = {}
+
+    def progress(**counts):
+        if shared.get(('cancel', job_id)):
+            raise JobCancelled(job_id)
+        counts_so_far.update(counts)
+        shared[job_id] = counts_so_far
+
+    progress()
+    return fn(*args, progress=progress, **kwargs)
+
+
+class JobScheduler:
+    """Runs jobs in a bounded process pool and keeps the last `max_results` finished results for `result_ttl` seconds"""
+
+    def __init__(
+        self,
+        max_workers: int = MAX_WORKERS,
+        max_pending: int = MAX_PENDING,
+        result_ttl: float = RESULT_TTL,
+        max_results: int = MAX_RESULTS,
+    ):
+        # spawn, since forking the multi-threaded streamlit server is unsafe
+        self._context = multiprocessing.get_context('spawn')
+        self.max_workers = max_workers
+        self._pool = self._new_pool()
+        self._manager = self._context.Manager()
+        self._shared = self._manager.dict()
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.max_results = max_results
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Job] = {}
+        self._futures: Dict[str, concurrent.futures.Future] = {}
+        # the scheduler lives in st.cache_resource for the lifetime of the server
+        atexit.register(self.shutdown)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> str:
+        """`fn` must be picklable and accept a `progress` keyword argument"""
+        with self._lock:
+            self._purge()
+            num_pending = sum(job.state not in FINISHED for job in self._jobs.values())
+            if num_pending >= self.max_pending:
+                raise SchedulerBusy(f'{num_pending} jobs pending')
+            job_id = uuid.uuid4().hex
+            try:
+                future = self._pool.submit(_run, fn, job_id, self._shared, args, kwargs)
+            except concurrent.futures.process.BrokenProcessPool:
+                # a worker died (e.g. OOM killed); its job has failed, start over with a fresh pool
+                logger.error('[job] process pool broken, restarting')
+                self._pool.shutdown(wait=False)
+                self._pool = self._new_pool()
+                future = self._pool.submit(_run, fn, job_id, self._shared, args, kwargs)
+            self._jobs[job_id] = Job(job_id=job_id, submitted_at=time.time())
+            self._futures[job_id] = future
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        logger.info('[job] %s submitted', job_id)
+        return job_id
+
+    def _new_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        return concurrent.futures.ProcessPoolExecutor(self.max_workers, mp_context=self._context)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """A snapshot of the job, or None if it is unknown or expired"""
+        with self._lock:
+            self._purge()
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job = dataclasses.replace(job)
+            future = self._futures.get(job_id)
+        if job.state not in FINISHED:
+            job.progress = dict(self._shared.get(job_id, {}))
+            if future is not None and future.running() and job_id in self._shared:
+                job.state = JobState.RUNNING
+        return job
+
+    def cancel(self, job_id: str):
+        with self._lock:
+            future = self._futures.get(job_id)
+        if future is None:
+            return
+        if not future.cancel():
+            # already running, the worker stops at its next progress report
+            self._shared[('cancel', job_id)] = True
+
+    def shutdown(self):
+        with self._lock:
+            futures = list(self._futures.values())
+        for future in futures:
+            future.cancel()
+        self._pool.shutdown(wait=False)
+        self._manager.shutdown()
+
+    def _finish(self, job_id: str, future: concurrent.futures.Future):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            self._futures.pop(job_id, None)
+            if job is None:
+                return
+            job.finished_at = time.time()
+            if future.cancelled():
+                job.state = JobState.CANCELLED
+            elif isinstance(future.exception(), JobCancelled):
+                job.state = JobState.CANCELLED
+            elif future.exception() is not None:
+                job.state = JobState.FAILED
+                job.error = repr(future.exception())
+                logger.error('[job] %s failed: %s', job_id, job.error)
+            else:
+                job.state = JobState.DONE
+                job.result = future.result()
+            elapsed = job.finished_at - job.submitted_at
+            logger.info('[job] %s %s [elapsed] %.3f s', job_id, job.state.value, elapsed)
+            self._purge()
+        try:
+            self._shared.pop(job_id, None)
+            self._shared.pop(('cancel', job_id), None)
+        except Exception:
+            # the manager is gone during shutdown
+            pass
+
+    def _purge(self):
+        """Drop expired jobs, then the oldest finished ones beyond `max_results`; call with the lock held"""
+        now = time.time()
+        finished = sorted(
+            (job for job in self._jobs.values() if job.finished_at is not None),
+            key=lambda job: job.finished_at,
+        )
+        num_kept = 0
+        for job in reversed(finished):
+            if now - job.finished_at > self.result_ttl or num_kept >= self.max_results:
+                del self._jobs[job.job_id]
+            else:
+                num_kept += 1
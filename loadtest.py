@@ -0,0 +1,391 @@
+"""Simulate concurrent users driving the pipeline of main.py against local stand-ins for ygocdb and the image CDN.
+
+    python loadtest.py --users 8 --decks-per-user 5 --mode thread
+    python loadtest.py --users 4 --mode process --image --cdn-latency 0.1
+
+Reports throughput, p50/p95/p99 latency per stage, peak RSS and cache hit rates.
+"""
+import argparse
+import collections
+import concurrent.futures
+import dataclasses
+import http.server
+import io
+import json
+import logging
+import math
+import multiprocessing
+import os
+import pathlib
+import random
+import resource
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import pipeline
+import templates
+from utils import ALIAS2ID_PATH, ID2DATA_PATH, OLD2ID_PATH, Language
+
+# ygocdb and printing_utils read their URLs from the environment at import, so they are
+# imported only after main() has started the fake servers and set the variables
+
+STAGES = ['parse', 'resolve', 'pdf_jp', 'pdf_cn', 'pdf_en', 'image_pdf', 'total']
+
+NEW_CARD_ID_START = 100300000
+
+
+@dataclasses.dataclass
+class Options:
+    users: int = 4
+    decks_per_user: int = 5
+    mode: str = 'thread'
+    template: str = 'en'
+    image: bool = False
+    seed: int = 0
+    popular_cards: int = 600
+    new_card_rate: float = 0.03
+    alias_rate: float = 0.02
+    ygocdb_latency: float = 0.2
+    ygocdb_error_rate: float = 0.0
+    cdn_latency: float = 0.05
+    output: Optional[str] = None
+
+
+class FakeServer:
+    """ThreadingHTTPServer in a daemon thread that counts requests"""
+
+    def __init__(self, respond: Callable[[str], tuple], latency: float):
+        self.requests = 0
+        lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                with lock:
+                    server.requests += 1
+                time.sleep(latency)
+                status, body = respond(self.path)
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self._httpd.server_port}/'
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._httpd.shutdown()
+
+
+def fake_ygocdb(options: Options) -> FakeServer:
+    rng = random.Random(options.seed)
+    lock = threading.Lock()
+
+    def respond(path: str):
+        with lock:
+            failed = rng.random() < options.ygocdb_error_rate
+        if failed:
+            return 503, b'injected error'
+        card_id = int(path.rsplit('=', 1)[-1])
+        result = {
+            'id': card_id,
+            'cn_name': f'新卡 {card_id}',
+            'jp_name': f'新カード {card_id}',
+            'en_name': f'New Card {card_id}',
+            'data': {'type': rng.choice([0x21, 0x2, 0x4])},
+        }
+        return 200, json.dumps({'result': [result]}).encode()
+
+    return FakeServer(respond, options.ygocdb_latency)
+
+
+def fake_cdn(options: Options) -> FakeServer:
+    from PIL import Image
+
+    image = io.BytesIO()
+    Image.effect_noise((400, 580), 60).convert('RGB').save(image, format='JPEG', quality=85)
+    body = image.getvalue()
+    return FakeServer(lambda path: (200, body), options.cdn_latency)
+
+
+def make_ydks(options: Options) -> List[List[str]]:
+    """Decks drawn from a popular pool with a long tail, plus alias/old ids and unreleased cards"""
+    rng = random.Random(options.seed)
+    id2data = json.loads(ID2DATA_PATH.read_text(encoding='utf8'))
+    by_type = collections.defaultdict(list)
+    for card_id, data in id2data.items():
+        by_type[data['type']].append(int(card_id))
+    pools = {t: rng.sample(ids, min(len(ids), options.popular_cards)) for t, ids in by_type.items()}
+    weights = {t: [1 / (rank + 1) for rank in range(len(ids))] for t, ids in pools.items()}
+    odd_ids = [int(i) for i in json.loads(ALIAS2ID_PATH.read_text(encoding='utf8'))]
+    odd_ids += [int(i) for i in json.loads(OLD2ID_PATH.read_text(encoding='utf8'))]
+    new_ids = [NEW_CARD_ID_START + i for i in range(20)]  # the same new set shows up in many decks
+
+    def draw(card_type: str) -> int:
+        r = rng.random()
+        if r < options.new_card_rate:
+            return rng.choice(new_ids)
+        if r < options.new_card_rate + options.alias_rate:
+            return rng.choice(odd_ids)
+        return rng.choices(pools[card_type], weights[card_type])[0]
+
+    def section(size: int, mix: Dict[str, float]) -> List[str]:
+        lines = []
+        while len(lines) < size:
+            card_id = draw(rng.choices(list(mix), list(mix.values()))[0])
+            copies = rng.choices([1, 2, 3], [3, 2, 5])[0]
+            lines += [str(card_id)] * min(copies, size - len(lines))
+        return lines
+
+    main_mix = {'Monster': 0.45, 'Spell': 0.35, 'Trap': 0.2}
+    ydks = []
+    for _ in range(options.users * options.decks_per_user):
+        ydks.append(
+            ['#created by loadtest', '#main']
+            + section(rng.randint(40, 60), main_mix)
+            + ['#extra'] + section(15, {'Monster': 1})
+            + ['!side'] + section(15, main_mix)
+        )
+    return ydks
+
+
+_CARD_DB = None
+_ID2FULL_DATA = None
+_NEW_CARD_CACHE: Dict[int, object] = {}
+_CACHE_LOCK = threading.Lock()
+_COUNTERS = collections.Counter()
+
+
+def fetch_new_card(card_id: int):
+    """Stands in for the st.cache_data wrapper in main.py"""
+    import ygocdb  # deferred, see the top of the module
+
+    with _CACHE_LOCK:
+        _COUNTERS['new_card_lookups'] += 1
+        if card_id in _NEW_CARD_CACHE:
+            _COUNTERS['new_card_cache_hits'] += 1
+            return _NEW_CARD_CACHE[card_id]
+    try:
+        data = ygocdb.fetch_card(card_id)
+    except ygocdb.YgocdbUnavailable:
+        with _CACHE_LOCK:
+            _COUNTERS['ygocdb_unavailable'] += 1
+        return None
+    with _CACHE_LOCK:
+        _NEW_CARD_CACHE[card_id] = data
+    return data
+
+
+def card_db():
+    global _CARD_DB
+
+    with _CACHE_LOCK:
+        if _CARD_DB is None:
+            _CARD_DB = pipeline.CardDB(
+                id2data=json.loads(ID2DATA_PATH.read_text(encoding='utf8')),
+                alias2id=json.loads(ALIAS2ID_PATH.read_text(encoding='utf8')),
+                old2id=json.loads(OLD2ID_PATH.read_text(encoding='utf8')),
+                fetch_new_card=fetch_new_card,
+            )
+    return _CARD_DB
+
+
+def full_card_data() -> dict:
+    """Stands in for `printing_utils.read_data_tmp`, whose st.cache_resource does not cache without a runtime"""
+    global _ID2FULL_DATA
+    import printing_utils  # deferred, see the top of the module
+
+    with _CACHE_LOCK:
+        if _ID2FULL_DATA is None:
+            _ID2FULL_DATA = printing_utils.read_data_tmp()
+    return _ID2FULL_DATA
+
+
+def run_deck(lines: List[str], options: Options) -> Dict[str, float]:
+    template = templates.get(options.template)
+    timings = {}
+    start = last = time.perf_counter()
+
+    def lap(stage: str):
+        nonlocal last
+        now = time.perf_counter()
+        timings[stage] = now - last
+        last = now
+
+    deck = pipeline.ydk2deck(lines)
+    lap('parse')
+    card_ids = pipeline.resolve_deck(deck, card_db())
+    lap('resolve')
+    for stage, lang in [('pdf_jp', Language.JAPANESE), ('pdf_cn', Language.CHINESE), ('pdf_en', Language.ENGLISH)]:
+        kvs, _ = pipeline.deck2kvs(deck, lang=lang, template=template, fill_monster_in_spell=True)
+        pipeline.make_pdf(kvs, template).close()
+        lap(stage)
+    if options.image:
+        import printing_utils  # deferred, see the top of the module
+
+        # as main.py does, pass only the cards of this deck
+        id2full_data = {card_id: full_card_data().get(card_id) for card_id in set(card_ids)}
+        printing_utils.make_image_pdf(card_ids, {}, id2full_data=id2full_data).close()
+        with _CACHE_LOCK:
+            _COUNTERS['image_cards'] += len(card_ids)
+        lap('image_pdf')
+    timings['total'] = time.perf_counter() - start
+    return timings
+
+
+def run_user(ydks: List[List[str]], options: Options) -> tuple:
+    """One simulated user uploading decks back to back.
+
+    Returns the counters added by this user only, since a worker process may run several users in turn;
+    in thread mode users run at the same time and share the counters, so `run_threads` reads them directly.
+    """
+    with _CACHE_LOCK:
+        before = collections.Counter(_COUNTERS)
+    timings = [run_deck(lines, options) for lines in ydks]
+    with _CACHE_LOCK:
+        return timings, dict(_COUNTERS - before)
+
+
+def run_threads(per_user: List[List[List[str]]], options: Options) -> tuple:
+    with concurrent.futures.ThreadPoolExecutor(options.users) as pool:
+        results = list(pool.map(run_user, per_user, [options] * len(per_user)))
+    return [t for timings, _ in results for t in timings], dict(_COUNTERS)
+
+
+def run_processes(per_user: List[List[List[str]]], options: Options) -> tuple:
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(options.users, mp_context=context) as pool:
+        results = list(pool.map(run_user, per_user, [options] * len(per_user)))
+    counters = collections.Counter()
+    for _, c in results:
+        counters.update(c)
+    return [t for timings, _ in results for t in timings], dict(counters)
+
+
+# execution modes to compare; each runs every user concurrently and returns (timings, counters)
+MODES: Dict[str, Callable] = {
+    'thread': run_threads,
+    'process': run_processes,
+}
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    # nearest rank
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def ratio(num: float, den: float) -> Optional[float]:
+    return num / den if den else None
+
+
+def summarize(timings: List[Dict[str, float]], counters: Dict[str, int], servers: Dict[str, FakeServer],
+              elapsed: float, options: Options) -> dict:
+    stages = {}
+    for stage in STAGES:
+        values = sorted(t[stage] for t in timings if stage in t)
+        if values:
+            stages[stage] = {f'p{p}': percentile(values, p) for p in (50, 95, 99)}
+            stages[stage]['mean'] = sum(values) / len(values)
+
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    # ru_maxrss of RUSAGE_CHILDREN is the largest reaped child; only process mode has any workers
+    children_rss = (
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024 if options.mode == 'process' else None
+    )
+    lookups = counters.get('new_card_lookups', 0)
+    return {
+        'options': dataclasses.asdict(options),
+        'decks': len(timings),
+        'elapsed_s': elapsed,
+        'throughput_decks_per_s': len(timings) / elapsed,
+        'stages_s': stages,
+        'peak_rss_mb': {'self': self_rss, 'largest_child': children_rss},
+        'new_card_lookups': lookups,
+        'new_card_cache_hit_rate': ratio(counters.get('new_card_cache_hits', 0), lookups),
+        'ygocdb_requests': servers['ygocdb'].requests,
+        'ygocdb_unavailable': counters.get('ygocdb_unavailable', 0),
+        'image_cache_hit_rate': (
+            1 - servers['cdn'].requests / counters['image_cards'] if counters.get('image_cards') else None
+        ),
+    }
+
+
+def print_report(report: dict):
+    options = report['options']
+    print(
+        f"mode={options['mode']} users={options['users']} decks={report['decks']} "
+        f"elapsed={report['elapsed_s']:.2f}s throughput={report['throughput_decks_per_s']:.2f} decks/s"
+    )
+    print(f"{'stage':<10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'mean ms':>9}")
+    for stage, s in report['stages_s'].items():
+        print(f"{stage:<10} {s['p50'] * 1000:9.1f} {s['p95'] * 1000:9.1f} {s['p99'] * 1000:9.1f} {s['mean'] * 1000:9.1f}")
+    rss = report['peak_rss_mb']
+    child_rss = 'N/A' if rss['largest_child'] is None else f"{rss['largest_child']:.0f} MB"
+    print(f"peak RSS: {rss['self']:.0f} MB (self), {child_rss} (largest child)")
+
+    def pct(value):
+        return '-' if value is None else f'{value:.1%}'
+
+    print(
+        f"new card lookups: {report['new_card_lookups']}, cache hit rate {pct(report['new_card_cache_hit_rate'])}, "
+        f"ygocdb requests {report['ygocdb_requests']}, unavailable {report['ygocdb_unavailable']}"
+    )
+    print(f"image cache hit rate: {pct(report['image_cache_hit_rate'])}")
+
+
+def parse_args() -> Options:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    defaults = Options()
+    parser.add_argument('--users', type=int, default=defaults.users, help='concurrent users')
+    parser.add_argument('--decks-per-user', type=int, default=defaults.decks_per_user)
+    parser.add_argument('--mode', choices=list(MODES), default=defaults.mode)
+    parser.add_argument('--template', choices=templates.names(), default=defaults.template)
+    parser.add_argument('--image', action='store_true', help='also run make_image_pdf')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--popular-cards', type=int, default=defaults.popular_cards, help='pool size per card type')
+    parser.add_argument('--new-card-rate', type=float, default=defaults.new_card_rate, help='share of unreleased ids')
+    parser.add_argument('--alias-rate', type=float, default=defaults.alias_rate, help='share of alias and old ids')
+    parser.add_argument('--ygocdb-latency', type=float, default=defaults.ygocdb_latency, help='seconds')
+    parser.add_argument('--ygocdb-error-rate', type=float, default=defaults.ygocdb_error_rate)
+    parser.add_argument('--cdn-latency', type=float, default=defaults.cdn_latency, help='seconds')
+    parser.add_argument('--output', help='write the report as JSON')
+    return Options(**vars(parser.parse_args()))
+
+
+def main():
+    options = parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s | %(name)s | %(levelname)s | %(message)s')
+    logging.getLogger('pypdf').setLevel(logging.ERROR)
+    if options.image:
+        missing = [p for p in ('data/cards.json', 'simkai.ttf') if not pathlib.Path(p).exists()]
+        if missing:
+            raise SystemExit(f"--image needs {', '.join(missing)}")
+    servers = {'ygocdb': fake_ygocdb(options), 'cdn': fake_cdn(options)}
+    # read at import time by ygocdb and printing_utils, and inherited by spawned workers
+    os.environ['YGOCDB_API_URL'] = servers['ygocdb'].url
+    os.environ['YGOPRO_IMAGE_URL'] = servers['cdn'].url + '{card_id}.jpg'
+
+    ydks = make_ydks(options)
+    per_user = [ydks[i::options.users] for i in range(options.users)]
+
+    start = time.perf_counter()
+    timings, counters = MODES[options.mode](per_user, options)
+    elapsed = time.perf_counter() - start
+
+    report = summarize(timings, counters, servers, elapsed, options)
+    print_report(report)
+    if options.output:
+        with open(options.output, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
+    for server in servers.values():
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,23 @@
-import collections
 import hashlib
 import io
 import json
 import logging
 import pathlib
 import time
-from typing import List, Optional, Dict, Tuple
+from typing import List, Optional, Dict
 
-import pypdf
-import requests
 import streamlit as st
 
 import utils
 from utils import (
     ALIAS2ID_PATH, ID2DATA_PATH, OLD2ID_PATH,
-    Section, CardType, Language, CardData,
-    Record, Deck,
+    Language, CardData,
 )
+import jobs
+import pipeline
 import printing_utils
+import templates
+import ygocdb
 
 logger = logging.getLogger(__name__)
 
@@ -48,13 +48,9 @@ def read_old_db() -> Dict[str, int]:
 
 
 @st.cache_resource
-def read_adapter() -> Dict[str, int]:
-    return json.loads(pathlib.Path('adapter.json').read_text(encoding='utf8'))
-
-
-@st.cache_resource
-def read_adapter_en() -> Dict[str, int]:
-    return json.loads(pathlib.Path('adapter_en.json').read_text(encoding='utf8'))
+def get_image_scheduler() -> jobs.JobScheduler:
+    # shared by all sessions
+    return jobs.JobScheduler()
 
 
 @st.cache_resource(ttl=TTL)
@@ -100,230 +96,91 @@ if PRINT_IMAGE:
         st.text("Invalid JSON format")
 
 
-TEMPLATE = Language.CHINESE if USE_CHINESE else Language.ENGLISH
-EN_PDF_TEMPLATE_PATH = './KDE_DeckList.pdf'  # 上限 18 条, 自动放缩文字
-CN_PDF_TEMPLATE_PATH = './中文卡表模板.pdf'  # 上限 20 条, 不放缩文字, 经常显示不全
-if TEMPLATE == Language.ENGLISH:
-    ADAPTER = read_adapter_en()
-else:
-    ADAPTER = read_adapter()
-
-ID2DATA = read_db()
-ALIAS2ID = read_alias_db()
-OLD2ID = read_old_db()
-
-
-def ydk2deck(lines: List[str]) -> Deck:
-    section2ids: Dict[str, List[int]] = {s: [] for s in Section}
-    current_section = None
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        if line == '#main':
-            current_section = Section.MAIN
-        elif line == '#extra':
-            current_section = Section.EXTRA
-        elif line == '!side':
-            current_section = Section.SIDE
-        elif current_section is not None:
-            # ensure the content is a number
-            section2ids[current_section].append(int(line))
-
-    deck = Deck()
-    for section, ids in section2ids.items():
-        for card_id, count in collections.Counter(ids).items():
-            getattr(deck, section).append(Record(card_id=card_id, count=count))
-
-    return deck
+TEMPLATE = templates.CHINESE if USE_CHINESE else templates.ENGLISH
 
 
 @st.cache_data(ttl=TTL)
-def fetch_new_card(card_id: int) -> Optional[CardData]:
-    # it is currently single-threaded, but should be enough
-    url = f'https://ygocdb.com/api/v0/?search={card_id}'
-    try:
-        # TODO: No retry now
-        response = requests.get(url, timeout=10)
-    except:
-        logger.exception('')
-        return
-    logger.info('Getting new card %s', card_id)
-    if response.status_code != 200:
-        logger.error('Failed getting %s: %s', card_id, response.text)
-        return
-
-    results = response.json().get('result', [])
-    if len(results) == 1:
-        d = results[0]
-        if d['id'] != card_id:
-            # TODO: 不清楚这些卡 id 怎么关联上的
-            logger.warning('Different id for %s: %s', card_id, utils.adapt_dict(d))
-        return utils.adapt_dict(d)
-
-    logger.info('Fetched %s: %s', card_id, results)
-    for d in results:
-        if d['id'] == card_id:
-            return utils.adapt_dict(d)
-
-    logger.error('%s not found', card_id)
-
-
-def fetch_card_data(card_id: int) -> Optional[CardData]:
-    data = ID2DATA.get(str(card_id))
-
-    if data is None:
-        # 老 id 转换
-        card_id = OLD2ID.get(str(card_id), card_id)
-        data = ID2DATA.get(str(card_id))
-
-    if data is None:
-        # 关联异画卡
-        norm_card_id = ALIAS2ID.get(str(card_id), card_id)
-        data = ID2DATA.get(str(norm_card_id))
-
-    if data is not None:
-        return data
-
-    data = fetch_new_card(card_id)
-    return data
-
-
-def get_standard_card_id(card_id: int) -> Optional[int]:
-    """TODO: quite duplicate with `fetch_card_data`"""
-    data = ID2DATA.get(str(card_id))
-    if data is not None:
-        return card_id
-
-    # 老 id 转换
-    card_id = OLD2ID.get(str(card_id), card_id)
-    data = ID2DATA.get(str(card_id))
-    if data is not None:
-        return card_id
-
-    # 关联异画卡
-    norm_card_id = ALIAS2ID.get(str(card_id), card_id)
-    data = ID2DATA.get(str(norm_card_id))
-    if data is not None:
-        return norm_card_id
-
-    data = fetch_new_card(card_id)
-    if data is not None:
-        return card_id
-
-    logger.error('card id %s not found', card_id)
-
-
-def deck2kvs(
-    deck: Deck, lang: Language, fill_monster_in_spell: bool = False,
-) -> Tuple[Dict, Dict[str, List[Record]]]:
-    final_dict = {}
-
-    main_type_idx = {t: 0 for t in CardType}
-    main_type_count = {t: 0 for t in CardType}
-    main_type_overflow: Dict[str, List[Record]] = {t: [] for t in CardType}
-    main_type_overflow.update({'Unknown': []})
-    max_rows = 18 if TEMPLATE == lang.ENGLISH else 20
-    for record in deck.main:
-        card_type = record.type
-        if card_type is None:
-            main_type_overflow['Unknown'].append(record)
-            continue
-        main_type_idx[card_type] += 1
-        idx = main_type_idx[card_type]
-        main_type_count[card_type] += record.count
-        if idx > max_rows:
-            main_type_overflow[card_type].append(record)
-        final_dict.update(
-            {
-                ADAPTER.get(f'{card_type} {idx}', 'null'): getattr(record, lang),
-                ADAPTER.get(f'{card_type} Card {idx} Count', 'null'): record.count,
-            }
-        )
-    for t in CardType:
-        final_dict[ADAPTER[f'Total {t} Cards']] = main_type_count[t]
-    final_dict[ADAPTER['Main Deck Total']] = sum(main_type_count[t] for t in CardType)
-
-    # 怪兽太多时填到魔法栏, 从底部往上填, 和最后一张魔法卡至少空两行, 还有多余的怪兽输出到页面
-    if fill_monster_in_spell and main_type_overflow[CardType.MONSTER]:
-        num_filled_monsters = 0
-        num_unique_spells = main_type_idx[CardType.SPELL]
-
-        for minus_idx in range(len(main_type_overflow[CardType.MONSTER])):
-            # 魔法栏也填满了
-            if minus_idx + num_unique_spells + 2 >= max_rows:
-                continue
-
-            num_filled_monsters += 1
-            record = main_type_overflow[CardType.MONSTER].pop()
-            final_dict.update(
-                {
-                    ADAPTER.get(f'{CardType.SPELL} {max_rows - minus_idx}', 'null'):
-                        getattr(record, lang),
-                    ADAPTER.get(f'{CardType.SPELL} Card {max_rows - minus_idx} Count', 'null'):
-                        record.count,
-                }
-            )
-
-        if num_filled_monsters > 0:
-            final_dict.update(
-                {
-                    ADAPTER.get(
-                        f'{CardType.SPELL} {max_rows - num_filled_monsters}', 'null'
-                    ): '===以下怪兽===以上魔法===',
-                }
-            )
-
-    count = 0
-    for idx, record in enumerate(deck.extra, start=1):
-        final_dict.update(
-            {
-                ADAPTER.get(f'Extra Deck {idx}', 'null'): getattr(record, lang),
-                ADAPTER.get(f'Extra Deck {idx} Count', 'null'): record.count,
-            }
-        )
-        count += record.count
-    final_dict[ADAPTER['Total Extra Deck']] = count
-    final_dict[ADAPTER['Extra Deck Total']] = count
-
-    count = 0
-    for idx, record in enumerate(deck.side, start=1):
-        final_dict.update(
-            {
-                ADAPTER.get(f'Side Deck {idx}', 'null'): getattr(record, lang),
-                ADAPTER.get(f'Side Deck {idx} Count', 'null'): record.count,
-            }
-        )
-        count += record.count
-    final_dict[ADAPTER['Total Side Deck']] = count
-    final_dict[ADAPTER['Side Deck Total']] = count
+def _fetch_new_card(card_id: int) -> Optional[CardData]:
+    # raising keeps failed lookups out of the cache
+    return ygocdb.fetch_card(card_id)
 
-    return final_dict, main_type_overflow
 
-
-@st.cache_resource
-def read_template_pdf():
-    reader = pypdf.PdfReader(CN_PDF_TEMPLATE_PATH)
-    return reader.pages[0]
+def fetch_new_card(card_id: int) -> Optional[CardData]:
+    try:
+        return _fetch_new_card(card_id)
+    except ygocdb.YgocdbUnavailable as e:
+        logger.warning('ygocdb unavailable for %s: %r', card_id, e)
 
 
-@st.cache_resource
-def read_template_pdf_en():
-    reader = pypdf.PdfReader(EN_PDF_TEMPLATE_PATH)
-    return reader.pages[0]
+CARD_DB = pipeline.CardDB(
+    id2data=read_db(),
+    alias2id=read_alias_db(),
+    old2id=read_old_db(),
+    fetch_new_card=fetch_new_card,
+)
 
 
-def make_pdf(kvs: Dict, lang: Language) -> io.BytesIO:
-    writer = pypdf.PdfWriter()
-    if lang == Language.ENGLISH:
-        writer.add_page(read_template_pdf_en())
-    elif lang == Language.CHINESE:
-        writer.add_page(read_template_pdf())
-    writer.update_page_form_field_values(writer.pages[0], kvs)
+@st.experimental_fragment(run_every=1)
+def poll_image_job(job_id: str):
+    scheduler = get_image_scheduler()
+    job = scheduler.get(job_id)
+    if job is None or job.state in jobs.FINISHED:
+        st.rerun()
+
+    progress = job.progress
+    total = progress.get('total_cards') or 1
+    if job.state == jobs.JobState.PENDING:
+        st.progress(0, text='卡图排队中...')
+    elif 'cards_done' in progress:
+        st.progress(
+            progress['cards_done'] / total,
+            text=f"卡图排版中: {progress['cards_done']} 张, 已完成 {progress['pages_done']} 页",
+        )
+    else:
+        fetched = progress.get('cards_fetched', 0)
+        st.progress(fetched / total, text=f'下载卡图: {fetched}/{total} 张')
+    if st.button('取消生成卡图'):
+        scheduler.cancel(job_id)
+
+
+def show_image_job(card_ids: List[int], id2old_desc: Dict[int, str], pdf_name: str):
+    """Submit the image PDF once per deck and config, so download clicks do not rerun it"""
+    scheduler = get_image_scheduler()
+    image_jobs = st.session_state.setdefault('image_jobs', {})
+    key = hashlib.md5(json.dumps([card_ids, id2old_desc], sort_keys=True).encode()).hexdigest()
+
+    job = scheduler.get(image_jobs[key]) if key in image_jobs else None
+    if job is None:
+        try:
+            # workers get only the cards of this deck, not the whole of data/cards.json
+            id2full_data = printing_utils.read_data_tmp()
+            id2full_data = {card_id: id2full_data.get(card_id) for card_id in set(card_ids)}
+            image_jobs[key] = scheduler.submit(
+                printing_utils.make_image_pdf, card_ids, id2old_desc, id2full_data=id2full_data,
+            )
+        except jobs.SchedulerBusy:
+            logger.warning('image scheduler busy')
+            st.warning('生成卡图的人太多了, 请稍后再试')
+            return
+        except Exception:
+            logger.exception('failed to submit image job')
+            st.error('生成卡图失败, 请稍后再试')
+            return
+        poll_image_job(image_jobs[key])
+        return
 
-    content = io.BytesIO()
-    writer.write(content)
-    return content
+    if job.state == jobs.JobState.DONE:
+        st.download_button('下载可打印中文卡图', job.result.getvalue(), file_name='中文卡图打印@' + pdf_name)
+    elif job.state in (jobs.JobState.FAILED, jobs.JobState.CANCELLED):
+        if job.state == jobs.JobState.FAILED:
+            st.error('生成卡图失败')
+        else:
+            st.info('已取消生成卡图')
+        if st.button('重新生成卡图'):
+            del image_jobs[key]
+            st.rerun()
+    else:
+        poll_image_job(job.job_id)
 
 
 # note that streamlit will rerun the script when the user clicks the download button
@@ -338,47 +195,34 @@ if uploaded_file is not None:
         uploaded_file.name, md5, json.dumps(text),
     )
 
-    deck = ydk2deck(text.split('\n'))
-    card_ids = []
-
-    for section in Section:
-        for record in getattr(deck, section):
-            card_data = fetch_card_data(record.card_id)
-            card_ids += [get_standard_card_id(record.card_id)] * record.count
-            if card_data is None:
-                record.name_cn = f'{record.card_id} 未找到该卡'
-                continue
-            record.type = card_data['type']
-            if name_cn := card_data.get('sc_name'):
-                record.name_cn = name_cn  # 简中
-            else:
-                if name_cn := card_data.get('cn_name'):
-                    record.name_cn = '(旧译) ' + name_cn
-                else:
-                    record.name_cn = f'({record.card_id} 没找到中文译名)'
-            record.name_jp = card_data.get('jp_name', f'({record.card_id} 没找到日文译名)')
-            record.name_en = card_data.get('en_name', f'({record.card_id} 没找到英文译名)')
+    deck = pipeline.ydk2deck(text.split('\n'))
+    card_ids = pipeline.resolve_deck(deck, CARD_DB)
 
     pdf_name = uploaded_file.name
     if pdf_name.endswith('.ydk'):
         pdf_name = pdf_name[:-len('.ydk')]
     pdf_name = pdf_name + '.pdf'
 
-    final_dict, _ = deck2kvs(deck, lang=Language.JAPANESE, fill_monster_in_spell=FILL_MONSTER_IN_SPELL)
-    with make_pdf(final_dict, TEMPLATE) as content:
+    final_dict, _ = pipeline.deck2kvs(
+        deck, lang=Language.JAPANESE, template=TEMPLATE, fill_monster_in_spell=FILL_MONSTER_IN_SPELL,
+    )
+    with pipeline.make_pdf(final_dict, TEMPLATE) as content:
         st.download_button('下载日文卡表 JP', content, file_name='日文@' + pdf_name)
 
-    final_dict, _ = deck2kvs(deck, lang=Language.CHINESE, fill_monster_in_spell=FILL_MONSTER_IN_SPELL)
-    with make_pdf(final_dict, TEMPLATE) as content:
+    final_dict, _ = pipeline.deck2kvs(
+        deck, lang=Language.CHINESE, template=TEMPLATE, fill_monster_in_spell=FILL_MONSTER_IN_SPELL,
+    )
+    with pipeline.make_pdf(final_dict, TEMPLATE) as content:
         st.download_button('下载简中卡表 CN', content, file_name='简中@' + pdf_name)
 
-    final_dict, main_type_overflow = deck2kvs(deck, lang=Language.ENGLISH, fill_monster_in_spell=FILL_MONSTER_IN_SPELL)
-    with make_pdf(final_dict, TEMPLATE) as content:
+    final_dict, main_type_overflow = pipeline.deck2kvs(
+        deck, lang=Language.ENGLISH, template=TEMPLATE, fill_monster_in_spell=FILL_MONSTER_IN_SPELL,
+    )
+    with pipeline.make_pdf(final_dict, TEMPLATE) as content:
         st.download_button('下载英文卡表 EN', content, file_name='英文@' + pdf_name)
 
     if PRINT_IMAGE:
-        with printing_utils.make_image_pdf(card_ids, ID2OLD_DESC) as content:
-            st.download_button('下载可打印中文卡图', content, file_name='中文卡图打印@' + pdf_name)
+        show_image_job(card_ids, ID2OLD_DESC, pdf_name)
 
 
     elapsed = time.perf_counter() - start_time
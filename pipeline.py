@@ -0,0 +1,201 @@
+import collections
+import dataclasses
+import io
+import logging
+from typing import Callable, List, Optional, Dict, Tuple
+
+import pypdf
+
+from utils import (
+    Section, CardType, Language, CardData,
+    Record, Deck,
+)
+import templates
+
+logger = logging.getLogger(__name__)
+
+
+def ydk2deck(lines: List[str]) -> Deck:
+    section2ids: Dict[str, List[int]] = {s: [] for s in Section}
+    current_section = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line == '#main':
+            current_section = Section.MAIN
+        elif line == '#extra':
+            current_section = Section.EXTRA
+        elif line == '!side':
+            current_section = Section.SIDE
+        elif current_section is not None:
+            # ensure the content is a number
+            section2ids[current_section].append(int(line))
+
+    deck = Deck()
+    for section, ids in section2ids.items():
+        for card_id, count in collections.Counter(ids).items():
+            getattr(deck, section).append(Record(card_id=card_id, count=count))
+
+    return deck
+
+
+@dataclasses.dataclass
+class CardDB:
+    id2data: Dict[str, CardData]
+    alias2id: Dict[str, int]
+    old2id: Dict[str, int]
+    fetch_new_card: Callable[[int], Optional[CardData]]
+
+    def fetch_card_data(self, card_id: int) -> Optional[CardData]:
+        data = self.id2data.get(str(card_id))
+
+        if data is None:
+            # 老 id 转换
+            card_id = self.old2id.get(str(card_id), card_id)
+            data = self.id2data.get(str(card_id))
+
+        if data is None:
+            # 关联异画卡
+            norm_card_id = self.alias2id.get(str(card_id), card_id)
+            data = self.id2data.get(str(norm_card_id))
+
+        if data is not None:
+            return data
+
+        data = self.fetch_new_card(card_id)
+        return data
+
+    def get_standard_card_id(self, card_id: int) -> Optional[int]:
+        """TODO: quite duplicate with `fetch_card_data`"""
+        data = self.id2data.get(str(card_id))
+        if data is not None:
+            return card_id
+
+        # 老 id 转换
+        card_id = self.old2id.get(str(card_id), card_id)
+        data = self.id2data.get(str(card_id))
+        if data is not None:
+            return card_id
+
+        # 关联异画卡
+        norm_card_id = self.alias2id.get(str(card_id), card_id)
+        data = self.id2data.get(str(norm_card_id))
+        if data is not None:
+            return norm_card_id
+
+        data = self.fetch_new_card(card_id)
+        if data is not None:
+            return card_id
+
+        logger.error('card id %s not found', card_id)
+
+
+def resolve_deck(deck: Deck, db: CardDB) -> List[Optional[int]]:
+    """Fill in card names and types in place; return the standard id of every copy, for printing"""
+    card_ids = []
+
+    for section in Section:
+        for record in getattr(deck, section):
+            card_data = db.fetch_card_data(record.card_id)
+            card_ids += [db.get_standard_card_id(record.card_id)] * record.count
+            if card_data is None:
+                record.name_cn = f'{record.card_id} 未找到该卡'
+                continue
+            record.type = card_data['type']
+            if name_cn := card_data.get('sc_name'):
+                record.name_cn = name_cn  # 简中
+            else:
+                if name_cn := card_data.get('cn_name'):
+                    record.name_cn = '(旧译) ' + name_cn
+                else:
+                    record.name_cn = f'({record.card_id} 没找到中文译名)'
+            record.name_jp = card_data.get('jp_name', f'({record.card_id} 没找到日文译名)')
+            record.name_en = card_data.get('en_name', f'({record.card_id} 没找到英文译名)')
+
+    return card_ids
+
+
+def fill_row(
+    final_dict: Dict, fields: templates.FieldMap, section: templates.SectionKey, idx: int, name, count=None,
+):
+    """Rows beyond the capacity of the template are skipped"""
+    if not 1 <= idx <= fields.rows(section):
+        return
+    if (field := fields.names[section][idx - 1]) is not None:
+        final_dict[field] = name
+    if count is not None and (field := fields.counts[section][idx - 1]) is not None:
+        final_dict[field] = count
+
+
+def deck2kvs(
+    deck: Deck, lang: Language, template: templates.Template, fill_monster_in_spell: bool = False,
+) -> Tuple[Dict, Dict[str, List[Record]]]:
+    final_dict = {}
+    fields = template.fields
+
+    main_type_idx = {t: 0 for t in CardType}
+    main_type_count = {t: 0 for t in CardType}
+    main_type_overflow: Dict[str, List[Record]] = {t: [] for t in CardType}
+    main_type_overflow.update({'Unknown': []})
+    max_rows = template.max_rows
+    for record in deck.main:
+        card_type = record.type
+        if card_type is None:
+            main_type_overflow['Unknown'].append(record)
+            continue
+        main_type_idx[card_type] += 1
+        idx = main_type_idx[card_type]
+        main_type_count[card_type] += record.count
+        if idx > max_rows:
+            main_type_overflow[card_type].append(record)
+        fill_row(final_dict, fields, card_type, idx, getattr(record, lang), record.count)
+    for t in CardType:
+        for field in fields.totals[t]:
+            final_dict[field] = main_type_count[t]
+    for field in fields.main_totals:
+        final_dict[field] = sum(main_type_count[t] for t in CardType)
+
+    # 怪兽太多时填到魔法栏, 从底部往上填, 和最后一张魔法卡至少空两行, 还有多余的怪兽输出到页面
+    if fill_monster_in_spell and main_type_overflow[CardType.MONSTER]:
+        num_filled_monsters = 0
+        num_unique_spells = main_type_idx[CardType.SPELL]
+
+        for minus_idx in range(len(main_type_overflow[CardType.MONSTER])):
+            # 魔法栏也填满了
+            if minus_idx + num_unique_spells + 2 >= max_rows:
+                continue
+
+            num_filled_monsters += 1
+            record = main_type_overflow[CardType.MONSTER].pop()
+            fill_row(
+                final_dict, fields, CardType.SPELL, max_rows - minus_idx, getattr(record, lang), record.count,
+            )
+
+        if num_filled_monsters > 0:
+            fill_row(
+                final_dict, fields, CardType.SPELL, max_rows - num_filled_monsters, '===以下怪兽===以上魔法===',
+            )
+
+    for section in (Section.EXTRA, Section.SIDE):
+        count = 0
+        for idx, record in enumerate(getattr(deck, section), start=1):
+            fill_row(final_dict, fields, section, idx, getattr(record, lang), record.count)
+            count += record.count
+        for field in fields.totals[section]:
+            final_dict[field] = count
+
+    return final_dict, main_type_overflow
+
+
+def make_pdf(kvs: Dict, template: templates.Template) -> io.BytesIO:
+    # cloning the shared page reads from its reader, so the whole write is serialized;
+    # a fresh reader per call avoids the lock but is 2-4x slower
+    with template.page_lock:
+        writer = pypdf.PdfWriter()
+        writer.add_page(template.page)
+        writer.update_page_form_field_values(writer.pages[0], kvs)
+
+        content = io.BytesIO()
+        writer.write(content)
+    return content
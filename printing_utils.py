@@ -1,9 +1,11 @@
 import collections
+import functools
 import io
 import json
 import logging
+import os
 import pathlib
-from typing import Optional, List
+from typing import Optional, List, Callable, Dict
 
 import fpdf
 import requests
@@ -43,7 +45,9 @@ TEXTBOX_HEIGHT_RATIO = (888 - 712) / 948
 TEXTBOX_Y_RATIO_MONSTER = (738+2) / 948
 TEXTBOX_HEIGHT_RATIO_MONSTER = (857 - 738) / 948
 
-IMAGE_URL = 'https://cdn.233.momobako.com/ygopro/pics/{card_id}.jpg'
+# can be pointed at a local fake server when testing
+IMAGE_URL = os.environ.get('YGOPRO_IMAGE_URL', 'https://cdn.233.momobako.com/ygopro/pics/{card_id}.jpg')
+JPEG_QUALITY = 90
 
 
 @st.cache_resource()
@@ -53,38 +57,50 @@ def read_data_tmp():
     return ID2FULL_DATA
 
 
+# not read at import: job workers get only the card data of their job from the caller
 # ID2FULL_DATA = json.loads(pathlib.Path('data/cards.json').read_text(encoding='utf8'))
 # ID2FULL_DATA = {x['id']: x for _, x in ID2FULL_DATA.items()}
-ID2FULL_DATA = read_data_tmp()
 
 
-@st.cache_data(max_entries=300)
-def fetch_full_data(card_id: int) -> dict:
+# st.cache_data does not cache without a streamlit runtime, as in job workers;
+# this cache is per process, about 300 * 100 KB of JPEG at most
+@functools.lru_cache(maxsize=300)
+def _fetch_image(card_id: int) -> dict:
+    response = requests.get(IMAGE_URL.format(card_id=card_id))
+    response.raise_for_status()
+    image = Image.open(io.BytesIO(response.content))
+
+    width, height = image.size
+    rect_area = (
+        int(width * TEXTBOX_X_RATIO),
+        int(height * TEXTBOX_Y_RATIO),
+        int(width * TEXTBOX_X_RATIO) + int(width * TEXTBOX_WIDTH_RATIO),
+        int(height * TEXTBOX_Y_RATIO) + int(height * TEXTBOX_HEIGHT_RATIO),
+    )
+    cropped_image = image.crop(rect_area)
+    pixel_colors = list(cropped_image.getdata())
+    color_counter = collections.Counter(pixel_colors)
+    most_common_color = color_counter.most_common(1)[0][0]
+
+    image = image.resize((WIDTH_PX, HEIGHT_PX))
+    # image.save(f'images/{card_id}.jpg')
+    # encoded once here; fpdf embeds JPEG bytes as is (DCTDecode) and dedups identical bytes
+    jpeg = io.BytesIO()
+    image.convert('RGB').save(jpeg, format='JPEG', quality=JPEG_QUALITY)
+    return {
+        'image': jpeg.getvalue(),
+        'background_color': most_common_color,
+    }
+
+
+def fetch_full_data(card_id: int, id2full_data: Dict[int, dict]) -> Optional[dict]:
     try:
-        response = requests.get(IMAGE_URL.format(card_id=card_id))
-        image = Image.open(io.BytesIO(response.content))
-
-        width, height = image.size
-        rect_area = (
-            int(width * TEXTBOX_X_RATIO),
-            int(height * TEXTBOX_Y_RATIO),
-            int(width * TEXTBOX_X_RATIO) + int(width * TEXTBOX_WIDTH_RATIO),
-            int(height * TEXTBOX_Y_RATIO) + int(height * TEXTBOX_HEIGHT_RATIO),
-        )
-        cropped_image = image.crop(rect_area)
-        pixel_colors = list(cropped_image.getdata())
-        color_counter = collections.Counter(pixel_colors)
-        most_common_color = color_counter.most_common(1)[0][0]
-
-        image = image.resize((WIDTH_PX, HEIGHT_PX))
-        # image.save(f'images/{card_id}.jpg')
-        return {
-            'image': image,
-            'background_color': most_common_color,
-            'data': ID2FULL_DATA.get(card_id),  # TODO
-        }
-    except:
-        logger.exception('image for card id %s not downloadable')
+        image = _fetch_image(card_id)
+    except Exception:
+        # not cached, so it is retried next time
+        logger.exception('image for card id %s not downloadable', card_id)
+        return
+    return {**image, 'data': id2full_data.get(card_id)}  # TODO
 
 
 def estimate_cells_needed(pdf, text, cell_width):
@@ -107,7 +123,7 @@ def estimate_cells_needed(pdf, text, cell_width):
 # }
 
 
-def add_cards(pdf: fpdf.FPDF, data, ID2OLD_DESC):
+def add_cards(pdf: fpdf.FPDF, data, ID2OLD_DESC, progress: Optional[Callable[..., None]] = None):
     x = LEFT_MARGIN
     y = TOP_MARGIN
 
@@ -125,6 +141,7 @@ def add_cards(pdf: fpdf.FPDF, data, ID2OLD_DESC):
             x = LEFT_MARGIN
             y = TOP_MARGIN
 
+        # every copy of a card references the same image XObject
         pdf.image(d['image'], x, y, w=CARD_WIDTH_MM, h=CARD_HEIGHT_MM)
 
         # Place the textbox over the card image
@@ -157,13 +174,30 @@ def add_cards(pdf: fpdf.FPDF, data, ID2OLD_DESC):
         pdf.multi_cell(w, txt=card_text, border=0, align="L")
         x += CARD_WIDTH_MM + SPACING
 
+        if progress is not None:
+            pages_done = (i + 1) // CARDS_PER_PAGE if i + 1 < len(data) else pdf.page
+            progress(cards_done=i + 1, pages_done=pages_done)
 
-def make_image_pdf(card_ids: List[int], ID2OLD_DESC) -> io.BytesIO:
+
+def make_image_pdf(
+    card_ids: List[int], ID2OLD_DESC, progress: Optional[Callable[..., None]] = None,
+    id2full_data: Optional[Dict[int, dict]] = None,
+) -> io.BytesIO:
+    """`progress` is called with the counts of cards fetched, cards done and pages done.
+
+    `id2full_data` only needs the cards in `card_ids`; the full data is read if it is not given.
+    """
     print(len(card_ids))
+    if id2full_data is None:
+        id2full_data = read_data_tmp()
     # TODO
-    data = [fetch_full_data(card_id) for card_id in card_ids]
+    data = []
+    for i, card_id in enumerate(card_ids):
+        data.append(fetch_full_data(card_id, id2full_data))
+        if progress is not None:
+            progress(cards_fetched=i + 1, total_cards=len(card_ids))
     data = [i for i in data if i is not None]
     pdf = fpdf.FPDF(unit="mm", format="A4")
     pdf.add_page()
-    add_cards(pdf, data, ID2OLD_DESC)
+    add_cards(pdf, data, ID2OLD_DESC, progress)
     return io.BytesIO(pdf.output())
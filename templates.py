@@ -0,0 +1,127 @@
+import dataclasses
+import json
+import pathlib
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+import pypdf
+
+from utils import Section, CardType
+
+SectionKey = Union[CardType, Section]
+
+
+@dataclasses.dataclass(frozen=True)
+class SectionLayout:
+    rows: int
+    name_key: str  # adapter key of the name field, formatted with the 1-based row
+    count_key: str
+    total_keys: Tuple[str, ...] = ()
+
+
+@dataclasses.dataclass(frozen=True)
+class FieldMap:
+    """Field ids precompiled from the adapter, `names[section][row - 1]`; None if the field is missing"""
+    names: Dict[SectionKey, Tuple[Optional[str], ...]]
+    counts: Dict[SectionKey, Tuple[Optional[str], ...]]
+    totals: Dict[SectionKey, Tuple[str, ...]]
+    main_totals: Tuple[str, ...]
+
+    def rows(self, section: SectionKey) -> int:
+        return len(self.names[section])
+
+
+def main_deck_layout(rows: int) -> Dict[SectionKey, SectionLayout]:
+    layout: Dict[SectionKey, SectionLayout] = {
+        t: SectionLayout(rows, f'{t.value} {{}}', f'{t.value} Card {{}} Count', (f'Total {t.value} Cards',))
+        for t in CardType
+    }
+    layout[Section.EXTRA] = SectionLayout(
+        15, 'Extra Deck {}', 'Extra Deck {} Count', ('Total Extra Deck', 'Extra Deck Total'),
+    )
+    layout[Section.SIDE] = SectionLayout(
+        15, 'Side Deck {}', 'Side Deck {} Count', ('Total Side Deck', 'Side Deck Total'),
+    )
+    return layout
+
+
+class Template:
+    """A fillable decklist PDF; the adapter and the PDF are read on first use"""
+
+    def __init__(
+        self,
+        name: str,
+        pdf_path: Union[str, pathlib.Path],
+        adapter_path: Union[str, pathlib.Path],
+        sections: Dict[SectionKey, SectionLayout],
+        main_total_keys: Tuple[str, ...] = ('Main Deck Total',),
+    ):
+        self.name = name
+        self.pdf_path = pathlib.Path(pdf_path)
+        self.adapter_path = pathlib.Path(adapter_path)
+        self.sections = sections
+        self.main_total_keys = main_total_keys
+        self._lock = threading.Lock()
+        self._fields: Optional[FieldMap] = None
+        self._page: Optional[pypdf.PageObject] = None
+        # `page` is shared and pypdf is not thread-safe; hold this while writing a PDF from it
+        self.page_lock = threading.Lock()
+
+    @property
+    def max_rows(self) -> int:
+        return self.sections[CardType.MONSTER].rows
+
+    @property
+    def fields(self) -> FieldMap:
+        if self._fields is None:
+            with self._lock:
+                if self._fields is None:
+                    self._fields = self._compile()
+        return self._fields
+
+    @property
+    def page(self) -> pypdf.PageObject:
+        if self._page is None:
+            with self._lock:
+                if self._page is None:
+                    self._page = pypdf.PdfReader(self.pdf_path).pages[0]
+        return self._page
+
+    def _compile(self) -> FieldMap:
+        adapter: Dict[str, str] = json.loads(self.adapter_path.read_text(encoding='utf8'))
+        names, counts, totals = {}, {}, {}
+        for key, layout in self.sections.items():
+            rows = range(1, layout.rows + 1)
+            names[key] = tuple(adapter.get(layout.name_key.format(i)) for i in rows)
+            counts[key] = tuple(adapter.get(layout.count_key.format(i)) for i in rows)
+            totals[key] = tuple(adapter[k] for k in layout.total_keys)
+        return FieldMap(
+            names=names,
+            counts=counts,
+            totals=totals,
+            main_totals=tuple(adapter[k] for k in self.main_total_keys),
+        )
+
+
+_REGISTRY: Dict[str, Template] = {}
+
+
+def register(template: Template) -> Template:
+    _REGISTRY[template.name] = template
+    return template
+
+
+def get(name: str) -> Template:
+    return _REGISTRY[name]
+
+
+def names() -> List[str]:
+    return list(_REGISTRY)
+
+
+ENGLISH = register(Template(
+    'en', 'KDE_DeckList.pdf', 'adapter_en.json', main_deck_layout(18),  # 上限 18 条, 自动放缩文字
+))
+CHINESE = register(Template(
+    'cn', '中文卡表模板.pdf', 'adapter.json', main_deck_layout(20),  # 上限 20 条, 不放缩文字, 经常显示不全
+))
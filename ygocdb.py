@@ -0,0 +1,184 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import requests
+
+import utils
+from utils import CardData
+
+logger = logging.getLogger(__name__)
+
+# can be pointed at a local fake server when testing
+API_URL = os.environ.get('YGOCDB_API_URL', 'https://ygocdb.com/api/v0/')
+TIMEOUT = 10
+
+FAILURE_THRESHOLD = 3
+RECOVERY_TIMEOUT = 30
+
+
+class YgocdbUnavailable(Exception):
+    """ygocdb failed to answer, as opposed to answering that the card does not exist"""
+
+
+class CircuitOpen(YgocdbUnavailable):
+    pass
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share the result of a single call.
+
+    Streamlit runs every session in a thread of the same process, so this
+    coalesces lookups across sessions.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error: Optional[BaseException] = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Any, SingleFlight._Call] = {}
+
+    def do(self, key, fn: Callable[[], Any]):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = self._Call()
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class CircuitBreaker:
+    """Fail fast after `failure_threshold` consecutive failures.
+
+    After `recovery_timeout` seconds a single probe call is let through;
+    the circuit closes if it succeeds and opens again otherwise.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+        self,
+        failure_threshold: int = FAILURE_THRESHOLD,
+        recovery_timeout: float = RECOVERY_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and self._clock() - self._opened_at >= self.recovery_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and self._clock() - self._opened_at >= self.recovery_timeout:
+                # let exactly one probe through
+                self._state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info('ygocdb circuit closed')
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning('ygocdb circuit opened after %s failures', self._failures)
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+
+    def call(self, fn: Callable[[], Any]):
+        if not self.allow():
+            raise CircuitOpen('ygocdb circuit is open')
+        try:
+            result = fn()
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+_single_flight = SingleFlight()
+breaker = CircuitBreaker()
+
+
+def _search(card_id: int) -> list:
+    url = f'{API_URL}?search={card_id}'
+    logger.info('Getting new card %s', card_id)
+    try:
+        response = requests.get(url, timeout=TIMEOUT)
+    except requests.RequestException as e:
+        logger.exception('')
+        raise YgocdbUnavailable(str(e)) from e
+    if response.status_code != 200:
+        logger.error('Failed getting %s: %s', card_id, response.text)
+        raise YgocdbUnavailable(f'status {response.status_code}')
+    try:
+        return response.json().get('result', [])
+    except ValueError as e:
+        logger.error('Failed getting %s: %s', card_id, response.text)
+        raise YgocdbUnavailable('invalid json') from e
+
+
+def search(card_id: int) -> list:
+    """Raw search results; raise `YgocdbUnavailable` if ygocdb is failing"""
+    return _single_flight.do(card_id, lambda: breaker.call(lambda: _search(card_id)))
+
+
+def fetch_card(card_id: int) -> Optional[CardData]:
+    """Return None if the card does not exist; raise `YgocdbUnavailable` if ygocdb is failing"""
+    results = search(card_id)
+    if len(results) == 1:
+        d = results[0]
+        if d['id'] != card_id:
+            # TODO: 不清楚这些卡 id 怎么关联上的
+            logger.warning('Different id for %s: %s', card_id, utils.adapt_dict(d))
+        return utils.adapt_dict(d)
+
+    logger.info('Fetched %s: %s', card_id, results)
+    for d in results:
+        if d['id'] == card_id:
+            return utils.adapt_dict(d)
+
+    logger.error('%s not found', card_id)